@@ -24,6 +24,7 @@ import argparse
 import shlex
 import time
 import random
+import functools
 from datetime import date, datetime
 
 import pandas as pd
@@ -42,6 +43,15 @@ seednspecs = None
 seednreacts = None
 newname = None
 newmodel = None
+elements = None
+elements_ignc = None
+
+# regular expressions used to find element names in expressions
+re_cnmodel = re.compile(r'^CN=Root,Model=(.+?),')
+# names inside [], inside () and before .Attribute are found with a single scan
+re_contexts = re.compile(r'\[(.+?)\]|\(([^\[\]\(\)]+?)\)|([^\s\[\]\(\)]+?)\.\w')
+re_nestedparens = re.compile(r'\((.*\(.*\).*?)\)')
+re_attribute = re.compile(r'\.\w')
 
 
 #######################
@@ -82,19 +92,77 @@ def integer_range(astr, min=1, max=10):
 
 # function to check if a string is an element in the model, optionally ignore compartments
 def is_element(candidate, ignore_compartments):
-    el=False
-    if( (seednparams>0) and (candidate in mparams.index) ):
-        el=True
-    else:
-        if( (seedncomps>0) and (candidate in mcomps.index) ):
-            el=True
-        else:
-            if( (not ignore_compartments) and (seednspecs>0) and (candidate in mspecs.index) ):
-                el=True
-            else:
-                if( (seednreacts>0) and (candidate in mreacts.index) ):
-                    el=True
-    return el
+    if( ignore_compartments ):
+        return candidate in elements_ignc
+    return candidate in elements
+
+# function to find the names captured by a pattern that are elements, in order and without repetitions
+def find_elements(pattern, expression, ignore_compartments):
+    return dict.fromkeys(m.group(1) for m in pattern.finditer(expression) if is_element(m.group(1), ignore_compartments))
+
+# function to find the element names inside [], inside () and before .Attribute with one scan
+# returns the names found in each of these contexts, in order and without repetitions
+def find_context_elements(expression, ignore_compartments):
+    found = ({}, {}, {})
+    for m in re_contexts.finditer(expression):
+        name = m.group(m.lastindex)
+        if( is_element(name, ignore_compartments) ):
+            found[m.lastindex-1][name] = None
+        elif( m.lastindex == 2 ):
+            # not a name inside (), but there may be names before .Attribute in it, e.g. ( A.ParticleNumber )
+            for d in re_contexts.finditer(expression, m.start(2), m.end(2)):
+                if( is_element(d.group(d.lastindex), ignore_compartments) ):
+                    found[d.lastindex-1][d.group(d.lastindex)] = None
+    return found
+
+# function to check if an expression refers to any element, i.e. if fix_expression would change it
+def has_elements(expression, ignore_compartments):
+    if( is_element(expression, ignore_compartments) ):
+        return True
+    return any(find_context_elements(expression, ignore_compartments)) or bool(find_elements(re_nestedparens, expression, ignore_compartments))
+
+# function to classify a token of a reaction scheme, returns (head, tail, literal)
+# names become head + suffix + tail in each unit, literals (operators and numbers) are left as they are
+def scheme_token(t, check_literal):
+    if( check_literal and ( (t == '=') or (t == '->') or (t == '+') or is_float(t) or (t=="*") ) ):
+        return (t, '', True)
+    if re.match(r'\".+\"', t):
+        # quoted names get the suffix inside the quotes
+        q = t.rindex('"')
+        return (t[:q], t[q:], False)
+    return (t, '', False)
+
+# function to turn the classified tokens of a reaction scheme into the pieces of text between names
+# the scheme of each unit is then simply the pieces joined by the unit suffix
+def scheme_template(tokens):
+    pieces = []
+    words = []
+    for i, sub in enumerate(tokens):
+        if( i > 0 ):
+            # the modifiers are separated by a ;
+            words.append(';')
+        for (h, tl, lit) in sub:
+            words.append(h)
+            if( not lit ):
+                # the suffix goes here, start a new piece with the tail of the name
+                pieces.append(' '.join(words))
+                words = [tl]
+    pieces.append(' '.join(words))
+    return pieces
+
+# function to copy the MIRIAM annotations of a seed model element to a new element
+def copy_miriam_annotation(an, element):
+    if( an ):
+        if( 'creators' in an ):
+            set_miriam_annotation(creators=an['creators'],model=newmodel, element=element, replace=False)
+        if( 'references' in an ):
+            set_miriam_annotation(references=an['references'],model=newmodel, element=element, replace=False)
+        if( 'descriptions' in an ):
+            set_miriam_annotation(descriptions=an['descriptions'],model=newmodel, element=element, replace=False)
+        if( 'modifications' in an ):
+            set_miriam_annotation(modifications=an['modifications'],model=newmodel, element=element, replace=False)
+        if( 'created' in an ):
+            set_miriam_annotation(created=an['created'],model=newmodel, element=element, replace=False)
 
 # function to add a diffusive term to an ode expression
 def add_diffusive_term(expression, c, a, b):
@@ -129,49 +197,39 @@ def add_regulatory_ratelaw(k):
 
 # function to change expression, fixing all references to element names with the appropriate suffix, with option to ignore compartments
 def fix_expression(exp, suff, ignore_compartments):
-    expression = str(exp)
+    # some arguments are COPASI objects, which cannot be cached, so use their string
+    return fix_string_expression(str(exp), suff, ignore_compartments)
+
+# function that does the work of fix_expression on a string
+# the result only depends on the arguments and on the element names and new model name, which are set before the first call
+# so it is cached, the same expressions are fixed for every unit and again when connecting units
+# (main() clears the cache whenever it sets the element names or the new model name)
+@functools.lru_cache(maxsize=None)
+def fix_string_expression(expression, suff, ignore_compartments):
     #is the full expression an element?
     if( is_element(expression, ignore_compartments) ):
         # just process it and return
         expression = expression + suff
         return expression
-    mname = re.findall(r'^CN=Root,Model=(.+?),', expression )
-    if( mname ):
-        expression = re.sub(r'^CN=Root,Model=(.+?),', fr'CN=Root,Model={newname},', expression )
-    # find object names inside []
-    evars = re.findall(r'\[(.+?)\]', expression )
-    if( evars ):
-        for el in evars:
-            #check that the variable exists
-            if( is_element(el, ignore_compartments) ):
-                elnew = el + suff
-                expression = re.sub(fr'\[{el}\]', fr'[{elnew}]', expression )
-    # find object names inside ()
-    evars = re.findall(r'\((.+?)\)', expression )
-    if( evars ):
-        for el in evars:
-            #check that the variable exists
-            if( is_element(el, ignore_compartments) ):
-                elnew = el + suff
-                expression = re.sub(fr'\({el}\)', f'({elnew})', expression )
-    # find object names inside () special case of ( something(else) )
-    evars = re.findall(r'\((.*\(.*\).*?)\)', expression )
-    if( evars ):
-        for el in evars:
-            #check that the variable exists
-            if( is_element(el, ignore_compartments) ):
-                elnew = el + suff
-                el = re.sub(r'\(', r'\\(', el)
-                el = re.sub(r'\)', r'\\)', el)
-                expression = re.sub(el,elnew, expression )
-    # find object names like R1.Rate, I2.InitialParticleNumber, etc.
-    evars = re.findall(r'([^\s\]\)]+?)\.\w', expression )
-    if( evars ):
-        for el in evars:
-            #check that the variable exists
-            if( is_element(el, ignore_compartments) ):
-                elnew = el + suff
-                expression = re.sub(fr'{el}\.(\w)', fr'{elnew}.\1', expression )
+    # the new model name is inserted literally, it may contain characters that re would interpret
+    expression = re_cnmodel.sub(lambda m: f'CN=Root,Model={newname},', expression )
+    # the names found are fixed in all their occurrences, the scans do not land on every one
+    # (e.g. 2*R1.Flux + R1.Flux or sin ( (R1).Flux ) + (R1).Flux)
+    inbrackets, inparens, dotted = find_context_elements(expression, ignore_compartments)
+    # fix object names inside []
+    for el in inbrackets:
+        expression = expression.replace(f'[{el}]', f'[{el}{suff}]')
+    # fix object names inside ()
+    for el in inparens:
+        expression = expression.replace(f'({el})', f'({el}{suff})')
+    # fix object names inside () special case of ( something(else) )
+    for el in find_elements(re_nestedparens, expression, ignore_compartments):
+        expression = expression.replace(el, el + suff)
+    # fix object names like R1.Rate, I2.InitialParticleNumber, etc.
+    # the suffix goes before every .Attribute that follows one of the names found
+    if( dotted ):
+        dotted = tuple(dotted)
+        expression = re_attribute.sub(lambda m: suff + m.group(0) if m.string.endswith(dotted, 0, m.start()) else m.group(0), expression )
     return expression
 
 # function to load and parse a graphviz network file, return list of links as tuples
@@ -259,7 +317,7 @@ def read_network(network_file):
 ############
 
 def main():
-    global mparams, mcomps, mspecs, mreacts, seednparams, seedncomps, seednspecs, seednreacts, newname, newmodel
+    global mparams, mcomps, mspecs, mreacts, seednparams, seedncomps, seednspecs, seednreacts, newname, newmodel, elements, elements_ignc
     
     #####
     #  1. parsing the command line
@@ -584,6 +642,14 @@ def main():
     else:
         seednreacts = mreacts.shape[0]
 
+    # sets of element names for fast lookup (species are not checked when ignoring compartments)
+    elements_ignc = frozenset().union(*(df.index for df in (mparams, mcomps, mreacts) if df is not None))
+    elements = elements_ignc
+    if( mspecs is not None ):
+        elements = elements | frozenset(mspecs.index)
+    # expressions fixed with other element names must not be reused
+    fix_string_expression.cache_clear()
+
     # get the events
     mevents = get_events(model=seedmodel, exact=True)
     if( mevents is None):
@@ -591,6 +657,48 @@ def main():
     else:
         seednevents = mevents.shape[0]
 
+    # keep the rows of each table in a dictionary, accessing these is much faster than pandas .loc[]
+    mparams_rec = {} if mparams is None else mparams.to_dict('index')
+    mcomps_rec = {} if mcomps is None else mcomps.to_dict('index')
+    mspecs_rec = {} if mspecs is None else mspecs.to_dict('index')
+    mreacts_rec = {} if mreacts is None else mreacts.to_dict('index')
+    mevents_rec = {} if mevents is None else mevents.to_dict('index')
+
+    # the columns used to create the elements of every unit, as plain tuples that start with the name
+    # element types that the seed does not have get no rows, so the main loop needs no checks for them
+    mparams_rows = [] if mparams is None else list(mparams[['initial_value','unit','type','initial_expression','expression']].itertuples(index=True, name=None))
+    # with ignore_compartments the units share the original compartments, so none are created per unit
+    mcomps_rows = [] if (mcomps is None or ignc) else list(mcomps[['initial_size','unit','type','dimensionality','initial_expression','expression']].itertuples(index=True, name=None))
+    mspecs_rows = [] if mspecs is None else list(mspecs[['initial_concentration','compartment','unit','type','initial_expression','expression']].itertuples(index=True, name=None))
+    mreacts_rows = [] if mreacts is None else list(mreacts[['function']].itertuples(index=True, name=None))
+
+    # notes and annotations are the same in every unit, so read them from the seed model only once
+    seednotes = {}
+    seedannots = {}
+    for nm in [f'Values[{p}]' for p in mparams_rec] + [f'Compartments[{p}]' for p in mcomps_rec] + list(mspecs_rec) + list(mreacts_rec) + list(mevents_rec):
+        seednotes[nm] = get_notes(model=seedmodel, name=nm)
+        seedannots[nm] = get_miriam_annotation(model=seedmodel, name=nm)
+
+    # split the reaction schemes only once, they are also the same in every unit
+    rschemes = {}
+    for p in mreacts_rec:
+        tok = [shlex.split(sub, posix=False) for sub in mreacts_rec[p]['scheme'].split(';')]
+        # only substrates and products can contain literals, modifiers are all names
+        rschemes[p] = scheme_template([[scheme_token(t, i == 0) for t in sub] for i, sub in enumerate(tok)])
+
+    # prepare the parameter mappings of each reaction in the same way, as (key, token(s), islist)
+    # names get the suffix, while values of local parameters are kept as literals
+    rmappings = {}
+    for p in mreacts_rec:
+        rmappings[p] = []
+        for key, v in mreacts_rec[p]['mapping'].items():
+            if( isinstance(v, str) ):
+                rmappings[p].append((key, scheme_token(v, False), False))
+            elif( isinstance(v, list) ):
+                rmappings[p].append((key, [scheme_token(k2, False) for k2 in v], True))
+            else:
+                rmappings[p].append((key, (v, '', True), False))
+
     # create string for summary of base model
     if( not args.quiet ):
         base_model_summary = f"  Reactions:         {seednreacts}\n"
@@ -682,6 +790,8 @@ def main():
 
     # create the new model name
     newname = f"{desc} of {seedname}"
+    # expressions fixed with another model name must not be reused
+    fix_string_expression.cache_clear()
 
     # create the new model
     newmodel = new_model(name=newname,
@@ -718,9 +828,9 @@ def main():
     # if we are ignoring compartments, then simply copy the compartments to the new model
     if ignc:
         for p in mcomps.index:
-            add_compartment(model=newmodel, name=p, status=mcomps.loc[p].at['type'], initial_size=mcomps.loc[p].at['initial_size'], unit=mcomps.loc[p].at['unit'], dimensionality=int(mcomps.loc[p].at['dimensionality']), expression=mcomps.loc[p].at['expression'], initial_expression=mcomps.loc[p].at['initial_expression'] )
-            if( 'notes' in mcomps.loc[p] ):
-                set_compartment(model=newmodel, name=p, notes=mcomps.loc[p].at['notes'])
+            add_compartment(model=newmodel, name=p, status=mcomps_rec[p]['type'], initial_size=mcomps_rec[p]['initial_size'], unit=mcomps_rec[p]['unit'], dimensionality=int(mcomps_rec[p]['dimensionality']), expression=mcomps_rec[p]['expression'], initial_expression=mcomps_rec[p]['initial_expression'] )
+            if( 'notes' in mcomps_rec[p] ):
+                set_compartment(model=newmodel, name=p, notes=mcomps_rec[p]['notes'])
 
     # if we want to have synapses with linked g, create the master g
     if( args.ode_synaptic and linkg ):
@@ -731,245 +841,162 @@ def main():
     #  MAIN LOOP FOR REPLICATION
     #####
 
+    # suffixes of all units in grid order, the units are independent of each other
     # we use "_i" as suffix for 1D, "_r,c" for 2D and "_r,c,l" for 3D
+    units = []
     i = 0
     for r in range(gridr):
         for c in range(gridc):
             for l in range(gridl):
                 if(dim==1):
-                    apdx = f"_{i+1}"
+                    units.append(f"_{i+1}")
                 else:
                     if(dim==2):
-                        apdx = f"_{r+1},{c+1}"
+                        units.append(f"_{r+1},{c+1}")
                     else:
-                        apdx = f"_{r+1},{c+1},{l+1}"
+                        units.append(f"_{r+1},{c+1},{l+1}")
+                i += 1
+
+    # names of the seed elements, in each unit they get the unit suffix
+    seedpnames = [row[0] for row in mparams_rows]
+    seedcnames = [row[0] for row in mcomps_rows]
+    seedsnames = [row[0] for row in mspecs_rows]
+    seedrnames = [row[0] for row in mreacts_rows]
+    seedspcomps = [row[2] for row in mspecs_rows]
+
+    # events whose trigger does not involve any model element other than time
+    # (or compartments when ignore_compartments is on) are dealt with later, the others are created in each unit
+    if( mevents is None ):
+        unitevents = []
+        timeonlyevents = []
+    else:
+        inunit = mevents['trigger'].astype(str).map(lambda t: has_elements(t, ignc))
+        unitevents = list(mevents.index[inunit])
+        timeonlyevents = list(mevents.index[~inunit])
+
+    for apdx in units:
+
+        # names of the elements in this unit
+        pnames = [p + apdx for p in seedpnames]
+        cnames = [p + apdx for p in seedcnames]
+        snames = [p + apdx for p in seedsnames]
+        rnames = [p + apdx for p in seedrnames]
+        # compartments of the species in this unit, with ignore_compartments they are the original ones
+        if( ignc ):
+            spcomps = seedspcomps
+        else:
+            spcomps = [p + apdx for p in seedspcomps]
 
     #####
     #  6. create parameters, compartments and species
     #####
-                # PARAMETERS
-                if( seednparams>0 ):
-                    for p in mparams.index:
-                        nname = p + apdx
-                        iv = mparams.loc[p].at['initial_value']
-                        if( p in noisy_param ):
-                            (level,dist) = noisy_param[p]
-                            iv = addnoise(mparams.loc[p].at['initial_value'], float(level), dist)
-                        add_parameter(model=newmodel, name=nname, status='fixed', initial_value=iv, unit=mparams.loc[p].at['unit'])
-                        nt = get_notes(model=seedmodel, name=f'Values[{p}]')
-                        if( nt is not None ):
-                            set_parameters(model=newmodel, exact=True, name=nname, notes=nt)
-                        an = get_miriam_annotation(model=seedmodel, name=f'Values[{p}]')
-                        if( an ):
-                            if( 'creators' in an ):
-                                set_miriam_annotation(creators=an['creators'],model=newmodel, name=nname, replace=False)
-                            if( 'references' in an ):
-                                set_miriam_annotation(references=an['references'],model=newmodel, name=nname, replace=False)
-                            if( 'descriptions' in an ):
-                                set_miriam_annotation(descriptions=an['descriptions'],model=newmodel, name=nname, replace=False)
-                            if( 'modifications' in an ):
-                                set_miriam_annotation(modifications=an['modifications'],model=newmodel, name=nname, replace=False)
-                            if( 'created' in an ):
-                                set_miriam_annotation(created=an['created'],model=newmodel, name=nname, replace=False)
-                # COMPARTMENTS
-                # if we are ignore_compartments, then we already created the original ones, nothing done here
-                if( (seedncomps > 0) and (not ignc) ):
-                    for p in mcomps.index:
-                        iv = mcomps.loc[p].at['initial_size']
-                        if( p in noisy_comp ):
-                            (level,dist) = noisy_comp[p]
-                            iv = addnoise(mcomps.loc[p].at['initial_size'], float(level), dist)
-                        nname = p + apdx
-                        add_compartment(model=newmodel, name=nname, status=mcomps.loc[p].at['type'], initial_size=iv, unit=mcomps.loc[p].at['unit'], dimensionality=int(mcomps.loc[p].at['dimensionality']) )
-                        nt = get_notes(model=seedmodel, name=f'Compartments[{p}]')
-                        if( nt is not None ):
-                            set_compartment(model=newmodel, name=nname, notes=nt)
-                        an = get_miriam_annotation(model=seedmodel, name=f'Compartments[{p}]')
-                        if( an ):
-                            if( 'creators' in an ):
-                                set_miriam_annotation(creators=an['creators'],model=newmodel, name=nname, replace=False)
-                            if( 'references' in an ):
-                                set_miriam_annotation(references=an['references'],model=newmodel, name=nname, replace=False)
-                            if( 'descriptions' in an ):
-                                set_miriam_annotation(descriptions=an['descriptions'],model=newmodel, name=nname, replace=False)
-                            if( 'modifications' in an ):
-                                set_miriam_annotation(modifications=an['modifications'],model=newmodel, name=nname, replace=False)
-                            if( 'created' in an ):
-                                set_miriam_annotation(created=an['created'],model=newmodel, name=nname, replace=False)
-                # SPECIES
-                if( seednspecs > 0):
-                    for p in mspecs.index:
-                        iv = mspecs.loc[p].at['initial_concentration']
-                        if( p in noisy_species ):
-                            (level,dist) = noisy_species[p]
-                            iv = addnoise(mspecs.loc[p].at['initial_concentration'], float(level), dist)
-                        nname = p + apdx
-                        if ignc:
-                            cp = mspecs.loc[p].at['compartment']
-                        else:
-                            cp = mspecs.loc[p].at['compartment'] + apdx
-                        add_species(model=newmodel, name=nname, compartment_name=cp, status=mspecs.loc[p].at['type'], initial_concentration=iv, unit=mspecs.loc[p].at['unit'])
-                        nt = get_notes(model=seedmodel, name=p)
-                        if( nt is not None ):
-                            set_species(model=newmodel, exact=True, name=nname, notes=nt)
-                        an = get_miriam_annotation(model=seedmodel, name=p)
-                        if( an ):
-                            if( 'creators' in an ):
-                                set_miriam_annotation(creators=an['creators'],model=newmodel, name=nname, replace=False)
-                            if( 'references' in an ):
-                                set_miriam_annotation(references=an['references'],model=newmodel, name=nname, replace=False)
-                            if( 'descriptions' in an ):
-                                set_miriam_annotation(descriptions=an['descriptions'],model=newmodel, name=nname, replace=False)
-                            if( 'modifications' in an ):
-                                set_miriam_annotation(modifications=an['modifications'],model=newmodel, name=nname, replace=False)
-                            if( 'created' in an ):
-                                set_miriam_annotation(created=an['created'],model=newmodel, name=nname, replace=False)
+        # expressions can only be set once all elements of this unit exist
+        # so they are fixed here but only set further down
+        exprs = []
+        # PARAMETERS
+        for ((p, piv, punit, ptype, pinit, pexp), nname) in zip(mparams_rows, pnames):
+            iv = piv
+            if( p in noisy_param ):
+                (level,dist) = noisy_param[p]
+                iv = addnoise(piv, float(level), dist)
+            el = add_parameter(model=newmodel, name=nname, status='fixed', initial_value=iv, unit=punit)
+            nt = seednotes[f'Values[{p}]']
+            if( nt is not None ):
+                set_notes(model=newmodel, element=el, notes=nt)
+            copy_miriam_annotation(seedannots[f'Values[{p}]'], el)
+            if( pinit ):
+                ie = fix_expression(pinit, apdx, ignc)
+                exprs.append((set_parameters, nname, {'initial_expression': ie}))
+            if( ptype=='assignment' or ptype=='ode'):
+                ex = fix_expression(pexp, apdx, ignc)
+                exprs.append((set_parameters, nname, {'status': ptype, 'expression': ex}))
+        # COMPARTMENTS
+        # if we are ignore_compartments, then we already created the original ones, there are no rows here
+        for ((p, csize, cunit, ctype, cdim, cinit, cexp), nname) in zip(mcomps_rows, cnames):
+            iv = csize
+            if( p in noisy_comp ):
+                (level,dist) = noisy_comp[p]
+                iv = addnoise(csize, float(level), dist)
+            el = add_compartment(model=newmodel, name=nname, status=ctype, initial_size=iv, unit=cunit, dimensionality=int(cdim) )
+            nt = seednotes[f'Compartments[{p}]']
+            if( nt is not None ):
+                set_notes(model=newmodel, element=el, notes=nt)
+            copy_miriam_annotation(seedannots[f'Compartments[{p}]'], el)
+            if( cinit ):
+                ie = fix_expression(cinit, apdx, ignc)
+                exprs.append((set_compartment, nname, {'initial_expression': ie}))
+            if( ctype=='assignment' or ctype=='ode'):
+                ex = fix_expression(cexp, apdx, ignc)
+                exprs.append((set_compartment, nname, {'expression': ex}))
+        # SPECIES
+        for ((p, sconc, scomp, sunit, stype, sinit, sexp), nname, cp) in zip(mspecs_rows, snames, spcomps):
+            iv = sconc
+            if( p in noisy_species ):
+                (level,dist) = noisy_species[p]
+                iv = addnoise(sconc, float(level), dist)
+            el = add_species(model=newmodel, name=nname, compartment_name=cp, status=stype, initial_concentration=iv, unit=sunit)
+            nt = seednotes[p]
+            if( nt is not None ):
+                set_notes(model=newmodel, element=el, notes=nt)
+            copy_miriam_annotation(seedannots[p], el)
+            if( sinit ):
+                ie = fix_expression(sinit, apdx, ignc)
+                exprs.append((set_species, nname, {'initial_expression': ie}))
+            if( stype=='assignment' or stype=='ode'):
+                ex = fix_expression(sexp, apdx, ignc)
+                exprs.append((set_species, nname, {'expression': ex}))
 
     #####
     #  7. create reactions
     #####
 
-                # REACTIONS
-                if( seednreacts > 0):
-                    for p in mreacts.index:
-                        nname = p + apdx
-                        scheme = mreacts.loc[p].at['scheme']
-                        tok = scheme.split(';')
-                        tok2 = [shlex.split(sub, posix=False) for sub in tok]
-                        # build the reaction string
-                        rs = ""
-                        for t in tok2[0]:
-                            if( (t == '=') or (t == '->') or (t == '+') or is_float(t) or (t=="*")):
-                                rs = rs + t + " "
-                            else:
-                                if re.match(r'\".+\"', t):
-                                    t = re.sub( r'\"(.+)\"', f'"\\1{apdx}"', t )
-                                    rs = rs + t + " "
-                                else:
-                                    rs = rs + t + apdx + " "
-                        if( len(tok2) > 1 ):
-                            # deal with the modifiers
-                            rs = rs[:len(rs)-1] + "; "
-                            for t in tok2[1]:
-                                if re.match(r'\".+\"', t):
-                                    t = re.sub( r'\"(.+)\"', f'"\\1{apdx}"', t )
-                                    rs = rs + t + " "
-                                else:
-                                    rs = rs + t + apdx + " "
-                        # fix the parameter mappings
-                        mapp = mreacts.loc[p].at['mapping'].copy()
-                        for key in mapp:
-                            if( isinstance(mapp[key], str) ):
-                                t = mapp[key]
-                                if re.match(r'\".+\"', t):
-                                    t = re.sub( r'\"(.+)\"', f'"\\1{apdx}"', t )
-                                else:
-                                    t = t + apdx
-                                mapp[key] = t
-                            else:
-                                if( isinstance(mapp[key], list ) ):
-                                    nmk = []
-                                    for k2 in mapp[key]:
-                                        if re.match(r'\".+\"', k2):
-                                            k2 = re.sub( r'\"(.+)\"', f'"\\1{apdx}"', k2 )
-                                        else:
-                                            k2 = k2 + apdx
-                                        nmk.append(k2)
-                                    mapp[key] = nmk
-                                    #mapp[key] = [k2 + apdx for k2 in mapp[key]]
-                        add_reaction(model=newmodel, name=nname, scheme=rs, mapping=mapp, function=mreacts.loc[p].at['function'] )
-                        nt = get_notes(model=seedmodel, name=p)
-                        if( nt is not None ):
-                            set_reaction(model=newmodel, exact=True, name=nname, notes=nt)
-                        an = get_miriam_annotation(model=seedmodel, name=p)
-                        if( an ):
-                            if( 'creators' in an ):
-                                set_miriam_annotation(creators=an['creators'],model=newmodel, name=nname, replace=False)
-                            if( 'references' in an ):
-                                set_miriam_annotation(references=an['references'],model=newmodel, name=nname, replace=False)
-                            if( 'descriptions' in an ):
-                                set_miriam_annotation(descriptions=an['descriptions'],model=newmodel, name=nname, replace=False)
-                            if( 'modifications' in an ):
-                                set_miriam_annotation(modifications=an['modifications'],model=newmodel, name=nname, replace=False)
-                            if( 'created' in an ):
-                                set_miriam_annotation(created=an['created'],model=newmodel, name=nname, replace=False)
+        # REACTIONS
+        for ((p, rfunc), nname) in zip(mreacts_rows, rnames):
+            # build the reaction string
+            rs = apdx.join(rschemes[p])
+            # fix the parameter mappings
+            mapp = {}
+            for (key, tk, islist) in rmappings[p]:
+                if( islist ):
+                    mapp[key] = [h + apdx + tl for (h, tl, lit) in tk]
+                elif( tk[2] ):
+                    mapp[key] = tk[0]
+                else:
+                    mapp[key] = tk[0] + apdx + tk[1]
+            el = add_reaction(model=newmodel, name=nname, scheme=rs, mapping=mapp, function=rfunc )
+            nt = seednotes[p]
+            if( nt is not None ):
+                set_notes(model=newmodel, element=el, notes=nt)
+            copy_miriam_annotation(seedannots[p], el)
     #####
     #  8. set expressions and initial_expressions
     #####
 
-                # PARAMETERS
-                if( seednparams > 0 ):
-                    for p in mparams.index:
-                        nname = p + apdx
-                        if( mparams.loc[p].at['initial_expression'] ):
-                            ie = fix_expression(mparams.loc[p].at['initial_expression'], apdx, ignc)
-                            set_parameters(model=newmodel, name=nname, exact=True, initial_expression=ie )
-                        if( mparams.loc[p].at['type']=='assignment' or mparams.loc[p].at['type']=='ode'):
-                            ex = fix_expression(mparams.loc[p].at['expression'], apdx, ignc)
-                            set_parameters(model=newmodel, name=nname, exact=True, status=mparams.loc[p].at['type'], expression=ex )
-                # COMPARTMENTS
-                if( (seedncomps > 0) and (not ignc) ):
-                    for p in mcomps.index:
-                        nname = p + apdx
-                        if( mcomps.loc[p].at['initial_expression'] ):
-                            ie = fix_expression(mcomps.loc[p].at['initial_expression'], apdx, ignc)
-                            set_compartment(model=newmodel, name=nname, exact=True, initial_expression=ie )
-                        if( mcomps.loc[p].at['type']=='assignment' or mcomps.loc[p].at['type']=='ode'):
-                            ex = fix_expression(mcomps.loc[p].at['expression'], apdx, ignc)
-                            set_compartment(model=newmodel, name=nname, exact=True, expression=ex )
-                # SPECIES
-                if( seednspecs > 0):
-                    for p in mspecs.index:
-                        nname = p + apdx
-                        if( mspecs.loc[p].at['initial_expression'] ):
-                            ie = fix_expression(mspecs.loc[p].at['initial_expression'], apdx, ignc)
-                            set_species(model=newmodel, name=nname, exact=True, initial_expression=ie )
-                        if( mspecs.loc[p].at['type']=='assignment' or mspecs.loc[p].at['type']=='ode'):
-                            ex = fix_expression(mspecs.loc[p].at['expression'], apdx, ignc)
-                            set_species(model=newmodel, name=nname, exact=True, expression=ex )
+        for (setter, nname, kw) in exprs:
+            setter(model=newmodel, name=nname, exact=True, **kw)
 
     #####
     #  9. create events
     #####
 
-                # EVENTS
-                timeonlyevents = []
-                if( seednevents > 0):
-                    for p in mevents.index:
-                        # fix the trigger expression
-                        tr = fix_expression(mevents.loc[p].at['trigger'], apdx, ignc)
-                        # we skip events that have no elements in the trigger (time-dependent only)
-                        if(tr != mevents.loc[p].at['trigger']):
-                            # fix name
-                            nm = p + apdx
-                            # process the targets and expressions
-                            assg = []
-                            for a in mevents.loc[p].at['assignments']:
-                                assg.append((fix_expression(a['target'],apdx, ignc),  fix_expression(a['expression'],apdx, ignc)))
-                            # add the event
-                            add_event(model=newmodel, name=nm, trigger=tr, assignments=assg, delay=fix_expression(mevents.loc[p].at['delay'],apdx, ignc), priority=fix_expression(mevents.loc[p].at['priority'],apdx, ignc), persistent=mevents.loc[p].at['persistent'], fire_at_initial_time=mevents.loc[p].at['fire_at_initial_time'], delay_calculation=mevents.loc[p].at['delay_calculation'])
-                            nt = get_notes(model=seedmodel, name=p)
-                            if( nt is not None ):
-                                set_notes(model=newmodel, name=nm, notes=nt)
-                            an = get_miriam_annotation(model=seedmodel, name=p)
-                            if( an ):
-                                if( 'creators' in an ):
-                                    set_miriam_annotation(creators=an['creators'],model=newmodel, name=nm, replace=False)
-                                if( 'references' in an ):
-                                    set_miriam_annotation(references=an['references'],model=newmodel, name=nm, replace=False)
-                                if( 'descriptions' in an ):
-                                    set_miriam_annotation(descriptions=an['descriptions'],model=newmodel, name=nm, replace=False)
-                                if( 'modifications' in an ):
-                                    set_miriam_annotation(modifications=an['modifications'],model=newmodel, name=nm, replace=False)
-                                if( 'created' in an ):
-                                    set_miriam_annotation(created=an['created'],model=newmodel, name=nm, replace=False)
-                        else:
-                            # the trigger does not involve any model element other than time
-                            # (or compartments when ignore_compartments is on)
-                            # add it to the list to be dealt with later
-                            timeonlyevents.append(p)
-
-                i += 1
+        # EVENTS
+        # (time-only events are skipped here, they were found before the loop)
+        for p in unitevents:
+            # fix the trigger expression
+            tr = fix_expression(mevents_rec[p]['trigger'], apdx, ignc)
+            # fix name
+            nm = p + apdx
+            # process the targets and expressions
+            assg = []
+            for a in mevents_rec[p]['assignments']:
+                assg.append((fix_expression(a['target'],apdx, ignc),  fix_expression(a['expression'],apdx, ignc)))
+            # add the event, without the full model compilation that basico does after each event
+            newmodel.getModel().setCompileFlag(False)
+            el = add_event(model=newmodel, name=nm, trigger=tr, assignments=assg, delay=fix_expression(mevents_rec[p]['delay'],apdx, ignc), priority=fix_expression(mevents_rec[p]['priority'],apdx, ignc), persistent=mevents_rec[p]['persistent'], fire_at_initial_time=mevents_rec[p]['fire_at_initial_time'], delay_calculation=mevents_rec[p]['delay_calculation'])
+            nt = seednotes[p]
+            if( nt is not None ):
+                set_notes(model=newmodel, element=el, notes=nt)
+            copy_miriam_annotation(seedannots[p], el)
 
     #####
     #  10. create events not dependent on variables
@@ -997,48 +1024,34 @@ def main():
         # loop over the time-only dependent events
         for p in timeonlyevents:
             # if the delay or priority expressions contain elements we use model_1
-            dl = fix_expression(mevents.loc[p].at['delay'],apdx1, ignc)
-            pr = fix_expression(mevents.loc[p].at['priority'],apdx1, ignc)
+            dl = fix_expression(mevents_rec[p]['delay'],apdx1, ignc)
+            pr = fix_expression(mevents_rec[p]['priority'],apdx1, ignc)
             if( not args.quiet ):
-                if( dl != mevents.loc[p].at['delay'] ):
+                if( dl != mevents_rec[p]['delay'] ):
                     print(f' Warning: Event {p} contains a delay expression dependent on variables, it was set to the variables of unit {apdx1}')
-                if( pr != mevents.loc[p].at['priority'] ):
+                if( pr != mevents_rec[p]['priority'] ):
                     print(f' Warning: Event {p} contains a priority expression dependent on variables, it was set to the variables of unit {apdx1}')
             # process the targets and expressions
             assg = []
-            for a in mevents.loc[p].at['assignments']:
+            for a in mevents_rec[p]['assignments']:
                 # now loop over all replicates to duplicate the targets
-                i = 0
-                for r in range(gridr):
-                    for c in range(gridc):
-                        for l in range(gridl):
-                            if(dim==1):
-                                apdx = f"_{i+1}"
-                            else:
-                                if(dim==2):
-                                    apdx = f"_{r+1},{c+1}"
-                                else:
-                                    apdx = f"_{r+1},{c+1},{l+1}"
-                            # add the assignment
-                            assg.append((fix_expression(a['target'],apdx, ignc), fix_expression(a['expression'],apdx, ignc)))
-                            i = i + 1
-            # add the event
-            add_event(model=newmodel, name=p, trigger=mevents.loc[p].at['trigger'], assignments=assg, delay=dl, priority=pr, persistent=mevents.loc[p].at['persistent'], fire_at_initial_time=mevents.loc[p].at['fire_at_initial_time'], delay_calculation=mevents.loc[p].at['delay_calculation'] )
-            nt = get_notes(model=seedmodel, name=p)
+                for apdx in units:
+                    # add the assignment
+                    assg.append((fix_expression(a['target'],apdx, ignc), fix_expression(a['expression'],apdx, ignc)))
+            # add the event, without the full model compilation that basico does after each event
+            newmodel.getModel().setCompileFlag(False)
+            el = add_event(model=newmodel, name=p, trigger=mevents_rec[p]['trigger'], assignments=assg, delay=dl, priority=pr, persistent=mevents_rec[p]['persistent'], fire_at_initial_time=mevents_rec[p]['fire_at_initial_time'], delay_calculation=mevents_rec[p]['delay_calculation'] )
+            nt = seednotes[p]
             if( nt is not None ):
-                set_notes(model=newmodel, name=p, notes=nt)
-            an = get_miriam_annotation(model=seedmodel, name=p)
-            if( an ):
-                if( 'creators' in an ):
-                    set_miriam_annotation(creators=an['creators'],model=newmodel, name=p, replace=False)
-                if( 'references' in an ):
-                    set_miriam_annotation(references=an['references'],model=newmodel, name=p, replace=False)
-                if( 'descriptions' in an ):
-                    set_miriam_annotation(descriptions=an['descriptions'],model=newmodel, name=p, replace=False)
-                if( 'modifications' in an ):
-                    set_miriam_annotation(modifications=an['modifications'],model=newmodel, name=p, replace=False)
-                if( 'created' in an ):
-                    set_miriam_annotation(created=an['created'],model=newmodel, name=p, replace=False)
+                set_notes(model=newmodel, element=el, notes=nt)
+            copy_miriam_annotation(seedannots[p], el)
+
+    # the model must be compiled again before it is used
+    newmodel.getModel().setCompileFlag(True)
+
+    # the expressions fixed for each unit are no longer needed,
+    # release them rather than keep memory proportional to the number of units until the end
+    fix_string_expression.cache_clear()
 
     #####
     # 11. create medium unit if needed
@@ -1056,8 +1069,8 @@ def main():
                 for (sp,ttype) in transported:
                     nname = f'{sp}_medium'
                     add_species(model=newmodel, name=nname, compartment_name=medium_name, status='reactions', initial_concentration=mspecs.loc[sp].at['initial_concentration'], unit=mspecs.loc[sp].at['unit'] )
-                    if( 'notes' in mspecs.loc[p] ):
-                        set_species(model=newmodel, name=nname, notes=mspecs.loc[p].at['notes'])
+                    if( 'notes' in mspecs.loc[sp] ):
+                        set_species(model=newmodel, name=nname, notes=mspecs.loc[sp].at['notes'])
 
             # it would be logic to create odes here too, but it is easier to create them further down
             # because they can be of one of three different types of entity
@@ -2312,6 +2325,9 @@ def main():
     # 14. save model
     #####
 
+    # the seed model is not needed anymore, free it before the new model is written
+    remove_datamodel(seedmodel)
+
     # get the base of the output model filename
     base,ext = os.path.splitext(newfilename)
 
@@ -0,0 +1,67 @@
+#!/bin/bash
+
+# work out our folder name
+test=${PWD##*/}          # to assign to a variable
+test=${test:-/}          # to correct for the case where PWD=/
+
+# run sbmodelr
+sbmodelr ../sources/RepeatedReferences.cps 2 1> output 2> /dev/null
+
+fail=0
+
+# compare output and target
+difference=$(diff output target_stdout)
+if [[ $difference ]]; then
+  printf 'FAIL %s\n' "${test}"
+  fail=1
+fi
+
+# create model summary
+../model_report.py RepeatedReferences_2.cps >/dev/null
+if ! [[ $? = 0 ]]; then
+  printf 'FAIL %s\n' "${test}"
+  exit -1
+fi
+
+# check that references to reactions with a . in their name are fixed
+n=$(grep -Pc "^f_([12])\s+assignment\s+\S+\s+Values\[k\.x_\1\] \* \(R\.1_\1\)\.Flux \+ \(v2_\1\)\.Flux" RepeatedReferences_2.summary.txt)
+if ((n != 2))  ; then
+  printf 'FAIL %s\n' "${test}"
+  let "fail = $fail + 2"
+fi
+
+# check that repeated references are all fixed
+n=$(grep -Pc "^g_([12])\s+assignment\s+\S+\s+\(R1_\1\)\.Flux \* \(R1_\1\)\.Flux" RepeatedReferences_2.summary.txt)
+if ((n != 2))  ; then
+  printf 'FAIL %s\n' "${test}"
+  let "fail = $fail + 4"
+fi
+n=$(grep -Pc "^h_([12])\s+assignment\s+\S+\s+2 \* A_\1\.ParticleNumber \+ A_\1\.ParticleNumber" RepeatedReferences_2.summary.txt)
+if ((n != 2))  ; then
+  printf 'FAIL %s\n' "${test}"
+  let "fail = $fail + 8"
+fi
+n=$(grep -Pc "^p_([12])\s+assignment\s+\S+\s+\( \[A_\1\] - \[B_\1\] \) / Compartments\[c_\1\]\.Volume \+ \[B_\1\] \* Compartments\[c_\1\]\.Volume" RepeatedReferences_2.summary.txt)
+if ((n != 2))  ; then
+  printf 'FAIL %s\n' "${test}"
+  let "fail = $fail + 16"
+fi
+n=$(grep -Pc "^s_([12])\s+assignment\s+\S+\s+sin \( \(R2_\1\)\.Flux \) \+ \(R2_\1\)\.Flux" RepeatedReferences_2.summary.txt)
+if ((n != 2))  ; then
+  printf 'FAIL %s\n' "${test}"
+  let "fail = $fail + 32"
+fi
+
+# check that a reference inside () is fixed when the () also contain a reference before .Attribute
+n=$(grep -Pc "^q_([12])\s+assignment\s+\S+\s+\( A_\1\.ParticleNumber \+ \(R1_\1\)\.Flux \) \* Values\[k1_\1\]" RepeatedReferences_2.summary.txt)
+if ((n != 2))  ; then
+  printf 'FAIL %s\n' "${test}"
+  let "fail = $fail + 64"
+fi
+
+if [ "$fail" = 0 ] ; then
+  printf 'PASS %s\n' "${test}"
+  rm RepeatedReferences_2.summary.txt output *.cps
+fi
+
+exit $fail